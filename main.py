@@ -2,22 +2,34 @@
 Main module for the SQL-based ETL process.
 Orchestrates the extraction, transformation, and loading of invoice data.
 """
+import argparse
+import itertools
 import time
+from concurrent.futures import ThreadPoolExecutor
 from src.extract import extract_invoice_data, test_connection
-from src.transform import transform_to_invoices
-from src.load import load_invoices_to_drive
+from src.transform import generate_references, iter_invoices
+from src.load import connect_to_drive, load_invoices_to_drive
 from utils.logging_config import logger
 
-def main():
+def main(refresh_cache=False):
     """
     Orchestrates the ETL process for SQL Server to Google Drive.
+    
+    Args:
+        refresh_cache (bool): Ignore the Drive cache saved by previous runs
     """
     start_time = time.time()
     logger.info("=" * 60)
     logger.info("STARTING SQL-BASED INVOICE ETL PROCESS")
     logger.info("=" * 60)
     
+    # Connecting to Google Drive (auth, folder and file listing) only needs the
+    # network, so it runs in the background while the database is queried
+    drive_setup = ThreadPoolExecutor(max_workers=1)
+    
     try:
+        drive_future = drive_setup.submit(connect_to_drive, refresh_cache)
+        
         # Test database connection first
         logger.info("Testing database connection...")
         if not test_connection():
@@ -34,20 +46,29 @@ def main():
         
         logger.info(f"✅ Successfully extracted {len(df)} rows from database")
         
-        # Transform data to invoice structure
+        # Transform data to invoice structure; invoices are built lazily and
+        # uploaded as they are produced instead of materializing the full list
         logger.info("🔄 Transforming data to invoice JSON structure...")
-        invoices = transform_to_invoices(df)
+        invoices = iter_invoices(df)
+        references = generate_references(df)
         
-        if not invoices:
+        first_invoice = next(invoices, None)
+        if first_invoice is None:
             logger.error("❌ No invoices generated during transformation. Aborting ETL process.")
             return False
         
-        logger.info(f"✅ Successfully transformed data into {len(invoices)} invoices")
+        drive_manager = drive_future.result()
+        if drive_manager is None:
+            logger.error("❌ Google Drive connection failed. Aborting ETL process.")
+            return False
         
         # Load invoices to Google Drive
         logger.info("📤 Uploading invoices to Google Drive...")
-        success = load_invoices_to_drive(invoices)
-        
+        success = load_invoices_to_drive(
+            itertools.chain([first_invoice], invoices),
+            drive_manager=drive_manager,
+            references=references
+        )
         
         # Calculate execution time
         execution_time = time.time() - start_time
@@ -56,7 +77,6 @@ def main():
             logger.info("=" * 60)
             logger.info("🎉 ETL PROCESS COMPLETED SUCCESSFULLY!")
             logger.info(f"⏱️  Execution time: {execution_time:.2f} seconds")
-            logger.info(f"📊 Processed {len(invoices)} invoices")
             logger.info("=" * 60)
             return True
         else:
@@ -74,10 +94,21 @@ def main():
         logger.critical(f"🔥 Error: {str(e)}")
         logger.critical("=" * 60, exc_info=True)
         return False
+        
+    finally:
+        drive_setup.shutdown(wait=False)
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="SQL Server to Google Drive invoice ETL")
+    parser.add_argument(
+        "--refresh-cache",
+        action="store_true",
+        help="Ignore the cached Drive folder/file listing and rebuild it"
+    )
+    args = parser.parse_args()
+    
     try:
-        success = main()
+        success = main(refresh_cache=args.refresh_cache)
         exit_code = 0 if success else 1
         exit(exit_code)
     except KeyboardInterrupt:
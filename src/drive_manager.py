@@ -2,34 +2,122 @@
 Google Drive manager for uploading invoice files.
 Adapted from the existing DriveManager service.
 """
+import gzip
 import os
-import json
-from pathlib import Path
-import tempfile
+import random
+import threading
 import uuid
 from typing import Optional
+import httplib2
+import google_auth_httplib2
+import orjson
 from googleapiclient.discovery import build
-from google.auth.transport.requests import Request
+from google.auth.transport.requests import AuthorizedSession, Request
 from google.oauth2.credentials import Credentials
-from googleapiclient.http import MediaFileUpload
 from googleapiclient.errors import HttpError
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import time
+from collections import OrderedDict
 from utils.logging_config import logger
 
+class RateLimiter:
+    """Limita una operación a un ritmo máximo compartido entre hilos"""
+    
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._next_slot = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def wait(self):
+        """Bloquea hasta que haya turno libre para la siguiente operación"""
+        if not self.interval:
+            return
+        
+        with self._lock:
+            now = time.monotonic()
+            slot = max(self._next_slot, now)
+            self._next_slot = slot + self.interval
+        
+        if slot > now:
+            time.sleep(slot - now)
+
 class DriveManager:
     """Clase para manejar la API de Google Drive"""
     
     SCOPES = ['https://www.googleapis.com/auth/drive']
+    HTTP_TIMEOUT = 60  # Segundos por petición HTTP
+    UPLOAD_RETRIES = 5  # Reintentos de cada subida ante 429/5xx y 403 de cuota
+    CACHE_TTL = 24 * 60 * 60  # Segundos de validez de la caché en disco
+    CLOCK_SKEW = 5 * 60  # Margen ante desfases de reloj con Drive al listar lo creado después
+    FOLDER_CACHE_MAX = 10_000  # Carpetas en caché antes de expulsar las menos usadas
+    FOLDER_CACHE_TTL = 60 * 60  # Segundos antes de revalidar un ID de carpeta
+    ID_BATCH_SIZE = 100  # IDs de archivo pedidos por llamada a generateIds
+    FOLDER_QUERY_BATCH = 50  # Nombres de carpeta por consulta de prewarm_folders
+    UPLOAD_URL = 'https://www.googleapis.com/upload/drive/v3/files?uploadType=multipart&fields=id'
+    # Motivos con los que Drive devuelve 403 por cuota; se reintentan, no son de autorización
+    RATE_LIMIT_REASONS = ('userRateLimitExceeded', 'rateLimitExceeded')
+    # JSON compacto en producción; INVOICE_PRETTY=1 lo indenta para depurar
+    JSON_OPTIONS = (
+        orjson.OPT_NON_STR_KEYS
+        | orjson.OPT_SERIALIZE_NUMPY
+        | (orjson.OPT_INDENT_2 if os.getenv('INVOICE_PRETTY', '').lower() in ('1', 'true', 'yes') else 0)
+    )
     
-    def __init__(self, credentials_path: str = 'credentials.json', token_path: str = 'token.json'):
+    __slots__ = (
+        'credentials_path', 'token_path', 'cache_path', 'gzip_uploads', '_write_limiter',
+        '_max_connections', '_cache_created', '_credentials', '_session', '_local', '_auth_lock',
+        '_folder_cache', '_folder_lock',
+        '_folder_files_cache', '_stored_files', '_files_lock', '_file_ids', '_ids_lock',
+    )
+    
+    def __init__(self, credentials_path: str = 'credentials.json', token_path: str = 'token.json',
+                 cache_path: str = '.drive_cache.json', gzip_uploads: bool = False,
+                 max_writes_per_second: float = 10, max_connections: int = 16):
         self.credentials_path = credentials_path
         self.token_path = token_path
-        self.service = None
-        self._folder_cache = {}
-        self._delayed_cleanup_files = []
+        self.cache_path = cache_path
+        self.gzip_uploads = gzip_uploads
+        # Cuota de escritura de Drive por usuario; 0 desactiva el límite
+        self._write_limiter = RateLimiter(max_writes_per_second)
+        self._max_connections = max_connections
+        self._cache_created = time.time()
+        self._credentials = None
+        self._session = None
+        self._local = threading.local()
+        self._auth_lock = threading.RLock()
+        self._folder_cache = OrderedDict()  # ruta -> (id, instante en que se cacheó)
+        self._folder_lock = threading.Lock()
+        self._folder_files_cache = {}
+        self._stored_files = {}  # carpeta -> nombres leídos de la caché en disco, sin verificar
+        self._files_lock = threading.Lock()
+        self._file_ids = []
+        self._ids_lock = threading.Lock()
+
+    @property
+    def service(self):
+        """Servicio de Drive del hilo actual.
 
+        El objeto httplib2.Http que usa googleapiclient no es thread-safe, así que
+        cada hilo construye su propio servicio a partir de las credenciales compartidas.
+        """
+        if self._credentials is None:
+            return None
+        
+        if getattr(self._local, 'credentials', None) is not self._credentials:
+            # Un Http persistente por hilo reutiliza la conexión TLS (keep-alive)
+            # en todas las llamadas del hilo en lugar de negociarla en cada una
+            http = google_auth_httplib2.AuthorizedHttp(
+                self._credentials,
+                http=httplib2.Http(timeout=self.HTTP_TIMEOUT)
+            )
+            self._local.service = build('drive', 'v3', http=http)
+            self._local.credentials = self._credentials
+        
+        return self._local.service
     
-    def authenticate(self):
+    def authenticate(self, force_refresh: bool = False):
         """Autentica y crea el servicio de Google Drive con manejo robusto de tokens"""
         creds = None
         
@@ -47,8 +135,8 @@ class DriveManager:
             raise Exception(f"❌ Error cargando token: {e}")
                 
         # Manejar credenciales inválidas o expiradas
-        if not creds.valid:
-            if creds.expired and creds.refresh_token:
+        if force_refresh or not creds.valid:
+            if (force_refresh or creds.expired) and creds.refresh_token:
                 try:
                     logger.info("🔄 Refrescando token expirado...")
                     creds.refresh(Request())
@@ -72,7 +160,12 @@ class DriveManager:
         
         # Crear servicio
         try:
-            self.service = build('drive', 'v3', credentials=creds)
+            # Sustituir credenciales y sesión a la vez: los hilos que siguen
+            # subiendo nunca ven una sesión a medio construir ni None
+            session = self._build_session(creds)
+            with self._auth_lock:
+                self._credentials = creds
+                self._session = session
             
             # Validar conexión y obtener info del usuario
             about_info = self.service.about().get(fields="user,storageQuota").execute()
@@ -115,7 +208,7 @@ class DriveManager:
                 # Limpiar token corrupto
                 if os.path.exists(self.token_path):
                     os.remove(self.token_path)
-                self.service = None
+                self._credentials = None
                 return False
             else:
                 logger.error(f"❌ Error de conexión HTTP: {e}")
@@ -124,134 +217,206 @@ class DriveManager:
             logger.error(f"❌ Conexión inválida: {e}")
             return False
     
-    def force_reauthentication(self):
-        """Fuerza una nueva autenticación eliminando tokens existentes"""
-        logger.info("🔄 Forzando re-autenticación...")
-        
-        # Eliminar token existente
-        if os.path.exists(self.token_path):
-            os.remove(self.token_path)
-            logger.info(f"🗑️ Token eliminado: {self.token_path}")
-        
-        # Limpiar servicio actual
-        self.service = None
-        
-        # Re-autenticar
-        return self.authenticate()
+    def force_reauthentication(self, failed_credentials=None):
+        """Fuerza una nueva autenticación recargando el token y refrescándolo"""
+        with self._auth_lock:
+            # Si otro hilo ya re-autenticó tras el mismo fallo, reutilizar su servicio
+            if failed_credentials is not None and self._credentials is not failed_credentials:
+                return self.service
+            
+            logger.info("🔄 Forzando re-autenticación...")
+            
+            # Re-autenticar; el token se conserva (sin él no se puede volver a
+            # autenticar sin ejecutar generar_token.py) y las credenciales
+            # actuales siguen en uso hasta que las nuevas estén listas
+            return self.authenticate(force_refresh=True)
+    
+    @staticmethod
+    def serialize_invoice(invoice_data: dict) -> bytes:
+        """Codifica la factura como JSON UTF-8 listo para subir"""
+        # orjson emite bytes UTF-8 directamente y acepta escalares numpy
+        return orjson.dumps(invoice_data, option=DriveManager.JSON_OPTIONS)
     
-    # Método mejorado para manejo de errores en uploads
     def upload_invoice_json(self, invoice_data: dict, filename: str, folder_path: str) -> bool:
-        """Sube un archivo JSON de factura a Google Drive con mejor manejo de errores"""
+        """Sube un archivo JSON de factura a Google Drive"""
+        return self.upload_bytes(self.serialize_invoice(invoice_data), filename, folder_path)
+    
+    # Método mejorado para manejo de errores en uploads
+    def upload_bytes(self, data: bytes, filename: str, folder_path: str, retry_auth: bool = True) -> bool:
+        """Sube un JSON ya serializado a Google Drive con mejor manejo de errores"""
         
-        # Validar conexión antes de proceder
-        if not self.validate_connection():
-            logger.info("🔄 Re-autenticando para subir archivo...")
-            try:
-                self.authenticate()
-            except Exception as e:
-                logger.error(f"❌ Error en re-autenticación: {e}")
-                return False
+        # La conexión se valida una sola vez al autenticar; un token caducado
+        # se detecta por el 401 de la propia subida
+        try:
+            with self._auth_lock:
+                if self._credentials is None:
+                    logger.info("🔄 Autenticando para subir archivo...")
+                    self.authenticate()
+        except Exception as e:
+            logger.error("❌ Error en autenticación: %s", e)
+            return False
+        credentials = self._credentials
         
-        temp_file = None
         try:
             folder_id = self.get_folder_id(folder_path)
             if not folder_id:
-                logger.error(f"❌ No se pudo obtener/crear la carpeta: {folder_path}")
+                logger.error("❌ No se pudo obtener/crear la carpeta: %s", folder_path)
                 return False
             
-            # Verificar si el archivo ya existe
-            existing_file_id = self._get_file_id_in_folder(filename, folder_id)
-            if existing_file_id:
-                logger.info(f"📄 Archivo ya existe, saltando: {filename}")
+            # Verificar si el archivo ya existe, reservando el nombre para que
+            # otro hilo no suba el mismo archivo a la vez
+            if not self._reserve_filename(filename, folder_id):
+                logger.info("📄 Archivo ya existe, saltando: %s", filename)
                 return True
             
-            # Crear archivo temporal
-            temp_file = tempfile.NamedTemporaryFile(
-                mode='w', 
-                suffix='.json', 
-                prefix=f'invoice_upload_{uuid.uuid4().hex[:8]}_',
-                delete=False,
-                encoding='utf-8'
-            )
-            
-            # Escribir datos JSON
-            json.dump(invoice_data, temp_file, ensure_ascii=False, indent=2)
-            temp_file.flush()
-            temp_file.close()
-            
-            # Preparar upload
-            media = MediaFileUpload(
-                temp_file.name,
-                mimetype='application/json',
-                resumable=True,
-                chunksize=1024*1024*8
-            )
-            
-            file_metadata = {
-                'name': filename,
-                'parents': [folder_id]
-            }
-            
-            request = self.service.files().create(
-                body=file_metadata,
-                media_body=media,
-                fields='id'
-            )
-            
-            # Ejecutar upload
-            response = self._execute_upload_with_retry(request, filename)
+            response = None
+            try:
+                # ID preasignado: si la respuesta de un intento se pierde y la
+                # sesión reintenta el POST, Drive devuelve 409 en vez de duplicar
+                file_id = self._next_file_id()
+                file_metadata = {
+                    'id': file_id,
+                    'name': filename,
+                    'parents': [folder_id]
+                }
+                
+                try:
+                    self._write_limiter.wait()
+                    response = self._post_multipart(file_metadata, data)
+                except requests.HTTPError as error:
+                    if error.response.status_code != 409:
+                        raise
+                    logger.info("📄 Archivo ya creado en un intento anterior: %s", filename)
+                    response = {'id': file_id}
+            finally:
+                if not response:
+                    # Liberar el nombre para que un reintento pueda subirlo
+                    self._release_filename(filename, folder_id)
             
             if response:
-                logger.info(f"✅ Archivo {filename} subido exitosamente")
+                logger.info("✅ Archivo %s subido exitosamente", filename)
                 return True
             else:
-                logger.error(f"❌ Error subiendo {filename}")
+                logger.error("❌ Error subiendo %s", filename)
                 return False
                 
-        except HttpError as e:
-            if e.resp.status in [401, 403]:
+        except (HttpError, requests.HTTPError) as e:
+            status = e.resp.status if isinstance(e, HttpError) else e.response.status_code
+            # Un 401 aquí significa que el refresco automático no bastó; los 403
+            # (cuota, permisos) no se arreglan re-autenticando
+            if status == 401 and retry_auth:
                 logger.warning("🔒 Error de autorización durante upload, reintentando...")
-                if self.force_reauthentication():
+                try:
+                    reauthenticated = self.force_reauthentication(failed_credentials=credentials)
+                except Exception as auth_error:
+                    logger.error("❌ Error en re-autenticación: %s", auth_error)
+                    return False
+                if reauthenticated:
                     # Reintentar upload una vez más
-                    return self.upload_invoice_json(invoice_data, filename, folder_path)
-            logger.error(f"❌ Error HTTP en upload: {e}")
+                    return self.upload_bytes(data, filename, folder_path, retry_auth=False)
+            logger.error("❌ Error HTTP en upload: %s", e)
             return False
             
         except Exception as e:
-            logger.error(f"❌ Error en upload_invoice_json: {e}")
+            logger.error("❌ Error en upload_bytes: %s", e)
             return False
+    
+    def _build_session(self, credentials) -> AuthorizedSession:
+        """Sesión HTTP autorizada compartida por todos los hilos de subida.
+
+        El pool de conexiones de requests mantiene abiertas las conexiones TLS
+        con el endpoint de subida, así que el handshake se paga una vez por
+        conexión y no una vez por archivo.
+        """
+        # Los 429, 5xx y errores de conexión se reintentan con backoff exponencial;
+        # reintentar el POST es seguro porque cada archivo lleva su ID preasignado
+        retry = Retry(
+            total=self.UPLOAD_RETRIES,
+            backoff_factor=1,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset(['POST']),
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=self._max_connections,
+            max_retries=retry
+        )
+        session = AuthorizedSession(credentials)
+        session.mount('https://', adapter)
+        return session
+    
+    def _post_multipart(self, metadata: dict, data: bytes) -> dict:
+        """Crea un archivo con una única petición multipart/related al endpoint de subida"""
+        boundary = uuid.uuid4().hex
+        body = b''.join([
+            f'--{boundary}\r\nContent-Type: application/json; charset=UTF-8\r\n\r\n'.encode(),
+            orjson.dumps(metadata),
+            f'\r\n--{boundary}\r\nContent-Type: application/json\r\n\r\n'.encode(),
+            data,
+            f'\r\n--{boundary}--'.encode(),
+        ])
+        headers = {'Content-Type': f'multipart/related; boundary={boundary}'}
+        if self.gzip_uploads:
+            # Nivel 1: casi toda la reducción del JSON a una fracción del coste de CPU
+            body = gzip.compress(body, compresslevel=1)
+            headers['Content-Encoding'] = 'gzip'
         
-        finally:
-            if temp_file and os.path.exists(temp_file.name):
-                self._cleanup_temp_file(temp_file.name, filename)
+        # AuthorizedSession refresca el token y repite la petición ante un 401;
+        # urllib3 reintenta los 429/5xx y aquí se reintentan los 403 de cuota
+        for attempt in range(self.UPLOAD_RETRIES + 1):
+            response = self._session.post(
+                self.UPLOAD_URL,
+                data=body,
+                headers=headers,
+                timeout=self.HTTP_TIMEOUT
+            )
+            if attempt == self.UPLOAD_RETRIES or not self._is_rate_limited(response):
+                break
+            
+            delay = 2 ** attempt + random.random()
+            logger.warning("⏳ Límite de peticiones de Drive, reintentando en %.1fs", delay)
+            time.sleep(delay)
+        
+        response.raise_for_status()
+        return response.json()
+    
+    def _is_rate_limited(self, response) -> bool:
+        """Indica si la respuesta es un 403 por cuota de Drive"""
+        if response.status_code != 403:
+            return False
+        try:
+            errors = orjson.loads(response.content)['error']['errors']
+            return any(error.get('reason') in self.RATE_LIMIT_REASONS for error in errors)
+        except (orjson.JSONDecodeError, KeyError, TypeError):
+            return False
     
     # Resto de métodos permanecen igual...
     def get_folder_id(self, folder_path: str, create_if_not_exists: bool = True) -> Optional[str]:
         """Obtiene el ID de una carpeta por su ruta"""
-        if folder_path in self._folder_cache:
-            return self._folder_cache[folder_path]
-        
+        # Serializa la búsqueda para que hilos concurrentes no creen la carpeta dos veces
+        with self._folder_lock:
+            return self._get_folder_id_locked(folder_path, create_if_not_exists)
+    
+    def _get_folder_id_locked(self, folder_path: str, create_if_not_exists: bool) -> Optional[str]:
+        """Busca o crea la carpeta; debe llamarse con _folder_lock adquirido"""
         try:
+            folder_id = self._cached_folder_id(folder_path)
+            if folder_id:
+                return folder_id
+            
             query = f"name='{folder_path}' and mimeType='application/vnd.google-apps.folder' and trashed=false"
             results = self.service.files().list(q=query, fields="files(id, name)").execute()
             folders = results.get('files', [])
             
             if folders:
                 folder_id = folders[0]['id']
-                self._folder_cache[folder_path] = folder_id
+                self._cache_folder(folder_path, folder_id)
                 logger.info(f"📁 Carpeta encontrada: {folder_path}")
                 return folder_id
             
             elif create_if_not_exists:
-                folder_metadata = {
-                    'name': folder_path,
-                    'mimeType': 'application/vnd.google-apps.folder'
-                }
-                folder = self.service.files().create(body=folder_metadata, fields='id').execute()
-                folder_id = folder.get('id')
-                self._folder_cache[folder_path] = folder_id
-                logger.info(f"📁 Carpeta creada: {folder_path}")
-                return folder_id
+                return self._create_folder(folder_path)
             
             return None
             
@@ -259,102 +424,235 @@ class DriveManager:
             logger.error(f"❌ Error buscando/creando carpeta {folder_path}: {error}")
             return None
     
-    def _get_file_id_in_folder(self, filename: str, folder_id: str) -> Optional[str]:
-        """Busca un archivo por nombre dentro de una carpeta específica"""
-        try:
-            query = f"name='{filename}' and '{folder_id}' in parents and trashed=false"
-            results = self.service.files().list(q=query, fields="files(id, name)").execute()
-            files = results.get('files', [])
-            return files[0]['id'] if files else None
-        except HttpError:
+    def _create_folder(self, folder_path: str) -> str:
+        """Crea la carpeta y la guarda en caché; debe llamarse con _folder_lock adquirido"""
+        folder_metadata = {
+            'name': folder_path,
+            'mimeType': 'application/vnd.google-apps.folder'
+        }
+        self._write_limiter.wait()
+        folder = self.service.files().create(body=folder_metadata, fields='id').execute()
+        folder_id = folder.get('id')
+        self._cache_folder(folder_path, folder_id)
+        logger.info(f"📁 Carpeta creada: {folder_path}")
+        return folder_id
+    
+    def _cache_folder(self, folder_path: str, folder_id: str):
+        """Guarda la carpeta en la caché LRU; debe llamarse con _folder_lock adquirido"""
+        self._folder_cache[folder_path] = (folder_id, time.time())
+        self._folder_cache.move_to_end(folder_path)
+        
+        while len(self._folder_cache) > self.FOLDER_CACHE_MAX:
+            self._folder_cache.popitem(last=False)
+    
+    def _cached_folder_id(self, folder_path: str) -> Optional[str]:
+        """ID en caché de la carpeta, revalidado contra Drive si la entrada es antigua"""
+        entry = self._folder_cache.get(folder_path)
+        if entry is None:
+            return None
+        
+        folder_id, cached_at = entry
+        if time.time() - cached_at <= self.FOLDER_CACHE_TTL:
+            self._folder_cache.move_to_end(folder_path)
+            return folder_id
+        
+        if not self._folder_exists(folder_id):
+            logger.info(f"📁 Carpeta en caché ya no existe en Drive: {folder_path}")
+            del self._folder_cache[folder_path]
             return None
+        
+        self._cache_folder(folder_path, folder_id)
+        return folder_id
+    
+    def _folder_exists(self, folder_id: str) -> bool:
+        """Comprueba que la carpeta sigue en Drive y no está en la papelera"""
+        try:
+            folder = self.service.files().get(fileId=folder_id, fields='id, trashed').execute()
+            return not folder.get('trashed', False)
+        except HttpError as error:
+            # Ante errores transitorios se mantiene el ID en caché
+            return error.resp.status != 404
     
-    def _execute_upload_with_retry(self, request, filename: str, max_retries: int = 3):
-        """Ejecuta upload con reintentos"""
-        for attempt in range(max_retries):
+    def prewarm_folders(self, folder_paths: list):
+        """Resuelve varias carpetas de una vez con consultas agrupadas por nombre"""
+        with self._folder_lock:
             try:
-                response = None
-                while response is None:
-                    status, response = request.next_chunk()
-                    if status:
-                        progress = int(status.progress() * 100)
-                        logger.debug(f"📊 Progreso {filename}: {progress}%")
+                pending = [
+                    path for path in dict.fromkeys(folder_paths)
+                    if self._cached_folder_id(path) is None
+                ]
+                if not pending:
+                    return
                 
-                return response
+                found = self._bulk_load_folders(pending)
                 
+                # Crear solo las carpetas que la consulta no encontró (normalmente
+                # pocas); la caché no sirve de referencia porque puede haber
+                # expulsado alguna durante la carga
+                for folder_path in pending:
+                    if folder_path not in found:
+                        self._create_folder(folder_path)
+                        
             except HttpError as error:
-                if error.resp.status == 429:  # Rate limit
-                    wait_time = (2 ** attempt) + 1
-                    logger.warning(f"⏳ Rate limit alcanzado. Esperando {wait_time}s...")
-                    time.sleep(wait_time)
-                elif error.resp.status >= 500:  # Server errors
-                    wait_time = (2 ** attempt) + 1
-                    logger.warning(f"⏳ Error servidor. Reintentando en {wait_time}s...")
-                    time.sleep(wait_time)
-                else:
-                    logger.error(f"❌ Error HTTP: {error}")
-                    break
-            except Exception as e:
-                logger.error(f"❌ Error en intento {attempt + 1}: {e}")
-                if attempt < max_retries - 1:
-                    time.sleep(2 ** attempt)
-        
-        return None
+                # get_folder_id resolverá individualmente las que falten
+                logger.warning(f"⚠️ Error precargando carpetas: {error}")
     
-    def _cleanup_temp_file(self, temp_file_path: str, filename: str, max_retries: int = 5):
-        """Elimina archivo temporal con reintentos y delay"""
-        for attempt in range(max_retries):
-            try:
-                time.sleep(0.1 * (attempt + 1))
-                os.unlink(temp_file_path)
-                logger.debug(f"🧹 Archivo temporal eliminado: {filename}")
-                return
-                
-            except PermissionError as e:
-                if attempt < max_retries - 1:
-                    logger.debug(f"🔄 Reintentando eliminación de archivo temporal (intento {attempt + 1})")
-                    continue
-                else:
-                    self._schedule_delayed_cleanup(temp_file_path)
-                    logger.warning(f"⚠️ Archivo temporal programado para eliminación diferida: {os.path.basename(temp_file_path)}")
+    def prewarm_folder_files(self, folder_path: str):
+        """Lista de antemano los archivos existentes en la carpeta"""
+        try:
+            folder_id = self.get_folder_id(folder_path)
+            if folder_id:
+                with self._files_lock:
+                    self._list_folder_files(folder_id)
                     
-            except Exception as cleanup_error:
-                logger.warning(f"⚠️ Error eliminando archivo temporal: {cleanup_error}")
-                break
+        except HttpError as error:
+            # La primera subida volverá a intentar el listado
+            logger.warning(f"⚠️ Error listando archivos de {folder_path}: {error}")
     
-    def _schedule_delayed_cleanup(self, temp_file_path: str):
-        """Programa un archivo para eliminación diferida"""
-        if not hasattr(self, '_delayed_cleanup_files'):
-            self._delayed_cleanup_files = []
-        
-        self._delayed_cleanup_files.append(temp_file_path)
-
-    def cleanup_delayed_files(self):
-        """Intenta eliminar archivos que no se pudieron eliminar anteriormente"""
-        if not hasattr(self, '_delayed_cleanup_files') or not self._delayed_cleanup_files:
-            return
-        
-        logger.info(f"🧹 Intentando limpiar {len(self._delayed_cleanup_files)} archivos temporales pendientes...")
-        
-        remaining_files = []
-        cleaned_count = 0
+    def _bulk_load_folders(self, folder_paths: list) -> set:
+        """Busca las carpetas indicadas, varias por consulta, y las guarda en caché"""
+        found = set()
+        for start in range(0, len(folder_paths), self.FOLDER_QUERY_BATCH):
+            batch = folder_paths[start:start + self.FOLDER_QUERY_BATCH]
+            names = ' or '.join(f"name='{self._escape_query(path)}'" for path in batch)
+            query = f"({names}) and mimeType='application/vnd.google-apps.folder' and trashed=false"
+            
+            page_token = None
+            while True:
+                results = self.service.files().list(
+                    q=query,
+                    fields="nextPageToken, files(id, name)",
+                    pageSize=1000,
+                    pageToken=page_token
+                ).execute()
+                for folder in results.get('files', []):
+                    # Ante nombres repetidos se conserva la primera, como en get_folder_id
+                    if folder['name'] not in found:
+                        found.add(folder['name'])
+                        self._cache_folder(folder['name'], folder['id'])
+                
+                page_token = results.get('nextPageToken')
+                if not page_token:
+                    break
         
-        for temp_file_path in self._delayed_cleanup_files:
-            try:
-                if os.path.exists(temp_file_path):
-                    os.unlink(temp_file_path)
-                    cleaned_count += 1
-                    logger.debug(f"🧹 Archivo temporal eliminado (diferido): {os.path.basename(temp_file_path)}")
-            except Exception:
-                remaining_files.append(temp_file_path)
+        logger.info(f"📁 {len(found)} carpetas encontradas en Drive")
+        return found
+    
+    @staticmethod
+    def _escape_query(value: str) -> str:
+        """Escapa un literal para usarlo entre comillas simples en una consulta de Drive"""
+        return value.replace('\\', '\\\\').replace("'", "\\'")
+    
+    def _next_file_id(self) -> str:
+        """Toma un ID de archivo del pool, pidiendo un lote nuevo a Drive si se agota"""
+        with self._ids_lock:
+            if not self._file_ids:
+                # num_retries también reintenta los 403 de cuota (rateLimitExceeded)
+                result = self.service.files().generateIds(
+                    count=self.ID_BATCH_SIZE,
+                    space='drive'
+                ).execute(num_retries=self.UPLOAD_RETRIES)
+                self._file_ids.extend(result.get('ids', []))
+            return self._file_ids.pop()
+    
+    def _list_folder_files(self, folder_id: str) -> set:
+        """Obtiene (una sola vez por carpeta) los nombres de archivo que contiene"""
+        if folder_id in self._folder_files_cache:
+            return self._folder_files_cache[folder_id]
         
-        self._delayed_cleanup_files = remaining_files
+        filenames = self._stored_files.pop(folder_id, set())
+        page_token = None
+        query = f"'{folder_id}' in parents and trashed=false"
+        if filenames:
+            # La caché en disco no incluye lo subido por una ejecución interrumpida
+            # ni por otra instancia: basta con listar lo creado desde que se hizo
+            since = time.gmtime(self._cache_created - self.CLOCK_SKEW)
+            query += f" and createdTime > '{time.strftime('%Y-%m-%dT%H:%M:%S', since)}'"
+        while True:
+            results = self.service.files().list(
+                q=query,
+                fields="nextPageToken, files(name)",
+                pageSize=1000,
+                pageToken=page_token
+            ).execute()
+            filenames.update(f['name'] for f in results.get('files', []))
+            
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                break
         
-        if cleaned_count > 0:
-            logger.info(f"✅ Se eliminaron {cleaned_count} archivos temporales pendientes")
+        self._folder_files_cache[folder_id] = filenames
+        logger.info(f"📋 {len(filenames)} archivos existentes en la carpeta")
+        return filenames
+    
+    def _reserve_filename(self, filename: str, folder_id: str) -> bool:
+        """Marca el archivo como presente en la carpeta; False si ya existía"""
+        with self._files_lock:
+            filenames = self._list_folder_files(folder_id)
+            if filename in filenames:
+                return False
+            filenames.add(filename)
+            return True
+    
+    def _release_filename(self, filename: str, folder_id: str):
+        """Deshace la reserva de un archivo cuya subida falló"""
+        with self._files_lock:
+            self._folder_files_cache.get(folder_id, set()).discard(filename)
+    
+    def load_cache(self) -> bool:
+        """Carga las cachés de carpetas y archivos guardadas por una ejecución anterior"""
+        if not os.path.exists(self.cache_path):
+            return False
         
-        if remaining_files:
-            logger.warning(f"⚠️ Quedan {len(remaining_files)} archivos temporales sin eliminar")
+        try:
+            with open(self.cache_path, 'rb') as cache_file:
+                cache = orjson.loads(cache_file.read())
+            
+            # La antigüedad se cuenta desde que se listó Drive, no desde el último guardado
+            if time.time() - cache['created'] > self.CACHE_TTL:
+                logger.info("🕒 Caché de Drive caducada, se reconstruirá")
+                return False
+            
+            with self._folder_lock, self._files_lock:
+                self._folder_cache = OrderedDict(
+                    (folder_path, (folder_id, cached_at))
+                    for folder_path, (folder_id, cached_at) in cache['folders'].items()
+                )
+                self._folder_files_cache = {}
+                self._stored_files = {
+                    folder_id: set(filenames) for folder_id, filenames in cache['files'].items()
+                }
+                self._cache_created = cache['created']
+            
+            logger.info(f"💾 Caché de Drive cargada: {len(self._folder_cache)} carpetas")
+            return True
+            
+        except Exception as e:
+            logger.warning(f"⚠️ No se pudo leer la caché de Drive: {e}")
+            return False
+    
+    def save_cache(self):
+        """Guarda las cachés de carpetas y archivos para la próxima ejecución"""
+        try:
+            with self._folder_lock, self._files_lock:
+                cache = {
+                    'created': self._cache_created,
+                    'folders': self._folder_cache,
+                    'files': {
+                        folder_id: sorted(filenames)
+                        for folder_id, filenames in {
+                            **self._stored_files, **self._folder_files_cache
+                        }.items()
+                    }
+                }
+                data = orjson.dumps(cache)
+            
+            with open(self.cache_path, 'wb') as cache_file:
+                cache_file.write(data)
+            logger.info(f"💾 Caché de Drive guardada en {self.cache_path}")
+            
+        except Exception as e:
+            logger.warning(f"⚠️ No se pudo guardar la caché de Drive: {e}")
     
     def test_connection(self) -> bool:
         """Prueba la conexión con Google Drive"""
@@ -2,14 +2,32 @@
 Extract module for the SQL-based ETL process.
 Handles database connection and data extraction.
 """
+import functools
+import os
 import pandas as pd
 import pyodbc
 from config.config import DB_CONFIG, INVOICE_QUERY
 from utils.logging_config import logger
 
+# Optional columnar fetch; falls back to pd.read_sql when not installed
+try:
+    import arrow_odbc
+    import pyarrow as pa
+except ImportError:
+    arrow_odbc = None
+
+USE_ARROW_ODBC = os.getenv('USE_ARROW_ODBC', '').lower() in ('1', 'true', 'yes')
+ARROW_BATCH_SIZE = 10000
+FETCH_BATCH_SIZE = 10000
+# Columns repeated on every line of an invoice; iva is left out because the
+# transform multiplies it
+CATEGORY_COLUMNS = ['pais', 'provincia', 'id_cliente', 'cliente']
+
+@functools.lru_cache(maxsize=1)
 def get_connection_string():
     """
     Creates a connection string for SQL Server.
+    Built once: DB_CONFIG does not change while the process runs.
     
     Returns:
         str: Connection string for pyodbc
@@ -37,6 +55,11 @@ def extract_invoice_data():
     Returns:
         pd.DataFrame: DataFrame with invoice data or None if error occurs
     """
+    if USE_ARROW_ODBC:
+        if arrow_odbc is not None:
+            return extract_invoice_data_arrow()
+        logger.warning("USE_ARROW_ODBC is set but arrow-odbc is not installed, using pyodbc")
+    
     connection = None
     try:
         logger.info("Connecting to SQL Server database")
@@ -44,17 +67,20 @@ def extract_invoice_data():
         connection = pyodbc.connect(connection_string)
         
         logger.info("Executing invoice query")
-        df = pd.read_sql(INVOICE_QUERY, connection)
+        chunks = list(iter_query_chunks(connection, INVOICE_QUERY))
         
-        logger.info(f"Successfully extracted {len(df)} rows from database")
+        df = concat_chunks(chunks)
+        df = to_categories(df)
+        
+        logger.info("Successfully extracted %d rows from database", len(df))
         return df
         
     except pyodbc.Error as e:
-        logger.error(f"Database error during extraction: {str(e)}")
+        logger.error("Database error during extraction: %s", e)
         return None
         
     except Exception as e:
-        logger.error(f"Error during data extraction: {str(e)}", exc_info=True)
+        logger.error("Error during data extraction: %s", e, exc_info=True)
         return None
         
     finally:
@@ -62,6 +88,109 @@ def extract_invoice_data():
             connection.close()
             logger.info("Database connection closed")
 
+def iter_query_chunks(connection, query, batch_size=FETCH_BATCH_SIZE):
+    """
+    Executes a query and yields its result set in DataFrame chunks, so the
+    full list of pyodbc rows is never held in memory at once.
+    
+    Args:
+        connection (pyodbc.Connection): Open database connection
+        query (str): SQL query to execute
+        batch_size (int): Rows fetched per round-trip
+        
+    Yields:
+        pd.DataFrame: Chunk of at most batch_size rows
+    """
+    cursor = connection.cursor()
+    cursor.arraysize = batch_size
+    cursor.execute(query)
+    columns = [column[0] for column in cursor.description]
+    
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        yield pd.DataFrame.from_records(
+            [tuple(row) for row in rows],
+            columns=columns,
+            coerce_float=True
+        )
+
+def concat_chunks(chunks):
+    """
+    Combines the fetched chunks into a single DataFrame.
+    
+    Args:
+        chunks (list): DataFrames yielded by iter_query_chunks
+        
+    Returns:
+        pd.DataFrame: All rows, with the query's column order
+    """
+    if not chunks:
+        return pd.DataFrame()
+    
+    # A column that is all NULL in one chunk carries no dtype information;
+    # pandas deprecates letting it decide the concat result, so it is left
+    # out and the reindex restores it (as NaN) in the original column order
+    df = pd.concat(
+        [chunk.dropna(axis=1, how='all') for chunk in chunks],
+        ignore_index=True
+    ).reindex(columns=chunks[0].columns)
+    
+    # Chunks infer dtypes independently (e.g. a column with NULLs in one chunk
+    # comes back as object); re-infer once on the combined frame
+    return df.infer_objects()
+
+def to_categories(df):
+    """
+    Stores the low-cardinality columns as categoricals, so each distinct
+    value is held once and rows keep only a small integer code.
+    
+    Args:
+        df (pd.DataFrame): Extracted invoice data
+        
+    Returns:
+        pd.DataFrame: The same DataFrame with CATEGORY_COLUMNS converted
+    """
+    for column in CATEGORY_COLUMNS:
+        if column in df.columns:
+            df[column] = df[column].astype('category')
+    return df
+
+def extract_invoice_data_arrow():
+    """
+    Extracts invoice data with arrow-odbc, fetching whole column batches
+    instead of building one Python object per cell as pyodbc does.
+    The returned DataFrame uses pd.ArrowDtype columns.
+    
+    Returns:
+        pd.DataFrame: DataFrame with invoice data or None if error occurs
+    """
+    try:
+        logger.info("Executing invoice query with arrow-odbc")
+        reader = arrow_odbc.read_arrow_batches_from_odbc(
+            query=INVOICE_QUERY,
+            connection_string=get_connection_string(),
+            batch_size=ARROW_BATCH_SIZE
+        )
+        table = pa.Table.from_batches(reader, schema=reader.schema)
+        
+        # pd.read_sql coerces DECIMAL columns to float; do the same so the
+        # DataFrame matches the pyodbc path
+        for index, field in enumerate(table.schema):
+            if pa.types.is_decimal(field.type):
+                table = table.set_column(index, field.name, table.column(index).cast(pa.float64()))
+        
+        # Keep the columns Arrow-backed: strings and dates are not boxed into
+        # one Python object per cell until the transform serializes them
+        df = to_categories(table.to_pandas(types_mapper=pd.ArrowDtype))
+        logger.info("Successfully extracted %d rows from database", len(df))
+        return df
+        
+    except Exception as e:
+        logger.error("Error during data extraction: %s", e, exc_info=True)
+        return None
+
 def test_connection():
     """
     Tests the database connection.
@@ -84,7 +213,7 @@ def test_connection():
         return True
         
     except Exception as e:
-        logger.error(f"Database connection test failed: {str(e)}")
+        logger.error("Database connection test failed: %s", e)
         return False
         
     finally:
@@ -2,29 +2,54 @@
 Load module for the SQL-based ETL process.
 Handles uploading invoices to Google Drive.
 """
+import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
 from src.drive_manager import DriveManager
 from config.config import DRIVE_FOLDER, OUTPUT_FILENAME_TEMPLATE, TOKEN_PATH
 from src.transform import generate_reference
 from utils.logging_config import logger
 
-def load_invoices_to_drive(invoices):
+# Concurrent uploads; the 429 backoff in DriveManager absorbs Drive quota spikes
+MAX_UPLOAD_WORKERS = int(os.getenv('DRIVE_UPLOAD_WORKERS', '16'))
+# Encoded payloads allowed to wait for a free upload worker
+MAX_PENDING_UPLOADS = 64
+
+def prepare_upload(invoice, references=None):
     """
-    Uploads invoice data to Google Drive.
+    Builds the Drive filename and JSON payload for an invoice.
     
     Args:
-        invoices (list): List of invoice dictionaries
+        invoice (dict): Invoice dictionary
+        references (dict): Precomputed references by invoice id, see generate_references
         
     Returns:
-        bool: True if all uploads successful, False otherwise
+        tuple: (filename, encoded JSON bytes)
     """
-    if not invoices:
-        logger.warning("No invoices to upload")
-        return True
-    
-    logger.info(f"Starting upload of {len(invoices)} invoices to Google Drive")
+    reference = references.get(invoice['id']) if references else None
+    if reference is None:
+        reference = generate_reference(invoice)
+    filename = OUTPUT_FILENAME_TEMPLATE.format(reference=reference)
+    return filename, DriveManager.serialize_invoice(invoice)
+
+def connect_to_drive(refresh_cache=False):
+    """
+    Creates an authenticated DriveManager with the target folder and its
+    existing files already cached, ready for uploading.
     
-    # Initialize DriveManager
-    drive_manager = DriveManager(token_path=str(TOKEN_PATH))
+    Args:
+        refresh_cache (bool): Ignore the Drive cache saved by previous runs
+        
+    Returns:
+        DriveManager: Connected DriveManager or None if connection fails
+    """
+    drive_manager = DriveManager(
+        token_path=str(TOKEN_PATH),
+        gzip_uploads=os.getenv('DRIVE_GZIP_UPLOADS', '').lower() in ('1', 'true', 'yes'),
+        max_writes_per_second=float(os.getenv('DRIVE_MAX_WRITES_PER_SECOND', '10')),
+        max_connections=MAX_UPLOAD_WORKERS
+    )
+    if not refresh_cache:
+        drive_manager.load_cache()
     
     try:
         # Authenticate
@@ -38,43 +63,94 @@ def load_invoices_to_drive(invoices):
         # Test connection
         if not drive_manager.test_connection():
             logger.error("❌ Error conectando con Google Drive")
-            return False
+            return None
+        
+        # Resolve the target folder and list its files before the first upload
+        drive_manager.prewarm_folders([DRIVE_FOLDER])
+        drive_manager.prewarm_folder_files(DRIVE_FOLDER)
+        return drive_manager
+        
+    except Exception as e:
+        logger.error("❌ Error conectando con Google Drive: %s", e)
+        return None
+
+def load_invoices_to_drive(invoices, refresh_cache=False, drive_manager=None, references=None):
+    """
+    Uploads invoice data to Google Drive.
+    
+    Invoices are consumed lazily, so a generator lets uploads start while
+    the rest of the invoices are still being transformed.
+    
+    Args:
+        invoices (iterable): Invoice dictionaries (list or generator)
+        refresh_cache (bool): Ignore the Drive cache saved by previous runs
+        drive_manager (DriveManager): Already connected manager, see connect_to_drive
+        references (dict): Precomputed filename references by invoice id
         
+    Returns:
+        bool: True if all uploads successful, False otherwise
+    """
+    if not invoices:
+        logger.warning("No invoices to upload")
+        return True
+    
+    logger.info("Starting upload of invoices to Google Drive")
+    
+    if drive_manager is None:
+        drive_manager = connect_to_drive(refresh_cache)
+        if drive_manager is None:
+            return False
+    
+    try:
         successful_uploads = 0
         failed_uploads = 0
         
-        for invoice in invoices:
+        def collect(future):
+            nonlocal successful_uploads, failed_uploads
+            invoice = pending.pop(future)
             try:
-                # Generate filename
-                reference = generate_reference(invoice)
-                filename = OUTPUT_FILENAME_TEMPLATE.format(reference=reference)
-                
-                # Upload invoice
-                success = drive_manager.upload_invoice_json(
-                    invoice_data=invoice,
-                    filename=filename,
-                    folder_path=DRIVE_FOLDER
-                )
-                
-                if success:
+                if future.result():
                     successful_uploads += 1
                 else:
                     failed_uploads += 1
                     
             except Exception as e:
-                logger.error(f"Error uploading invoice {invoice.get('id', 'unknown')}: {str(e)}")
+                logger.error("Error uploading invoice %s: %s", invoice.get('id', 'unknown'), e)
                 failed_uploads += 1
-
-        drive_manager.cleanup_delayed_files()
+        
+        # JSON encoding runs on this thread while workers wait on the network
+        pending = {}
+        with ThreadPoolExecutor(max_workers=MAX_UPLOAD_WORKERS) as executor:
+            for invoice in invoices:
+                if len(pending) >= MAX_PENDING_UPLOADS:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        collect(future)
+                
+                try:
+                    filename, data = prepare_upload(invoice, references)
+                except Exception as e:
+                    logger.error("Error preparing invoice %s: %s", invoice.get('id', 'unknown'), e)
+                    failed_uploads += 1
+                    continue
+                
+                future = executor.submit(drive_manager.upload_bytes, data, filename, DRIVE_FOLDER)
+                pending[future] = invoice
+            
+            for future in as_completed(list(pending)):
+                collect(future)
         
         # Log results
-        total_invoices = len(invoices)
-        logger.info(f"📊 RESULTADOS DE SUBIDA:")
-        logger.info(f"  ✅ Exitosos: {successful_uploads}")
-        logger.info(f"  ❌ Fallidos: {failed_uploads}")
-        logger.info(f"  📋 Total: {total_invoices}")
+        total_invoices = successful_uploads + failed_uploads
+        logger.info("📊 RESULTADOS DE SUBIDA:")
+        logger.info("  ✅ Exitosos: %d", successful_uploads)
+        logger.info("  ❌ Fallidos: %d", failed_uploads)
+        logger.info("  📋 Total: %d", total_invoices)
         
-        if successful_uploads == total_invoices:
+        if total_invoices == 0:
+            logger.warning("No invoices to upload")
+            return True
+        elif successful_uploads == total_invoices:
             logger.info("🎉 ¡Todas las facturas subidas correctamente!")
             return True
         elif successful_uploads > 0:
@@ -85,5 +161,10 @@ def load_invoices_to_drive(invoices):
             return False
             
     except Exception as e:
-        logger.error(f"❌ Error general subiendo facturas: {e}")
-        return False
\ No newline at end of file
+        logger.error("❌ Error general subiendo facturas: %s", e)
+        return False
+        
+    finally:
+        # Guardar también si la subida se interrumpe, para que la próxima
+        # ejecución conozca los archivos ya subidos
+        drive_manager.save_cache()
\ No newline at end of file
@@ -2,10 +2,22 @@
 Transform module for the SQL-based ETL process.
 Handles data transformation to invoice JSON structure.
 """
-import pandas as pd
+import logging
 import numpy as np
+import pandas as pd
 from utils.logging_config import logger
 
+# Invoice-level columns, taken from the first row of each invoice
+HEADER_COLUMNS = [
+    'id', 'num_factura', 'año_factura', 'fecha_factura', 'observaciones',
+    'num_albaran', 'fecha_albaran', 'id_pedido', 'num_pedido', 'año_pedido',
+    'fecha_pedido', 'id_pedido_cliente', 'id_cliente', 'cliente', 'direccion',
+    'cod_postal', 'ciudad', 'provincia', 'pais', 'nif'
+]
+
+# Line-level columns, one product per row
+PRODUCT_COLUMNS = ['id_articulo', 'descripcion', 'cantidad', 'precio', 'descuento', 'total']
+
 def transform_to_invoices(df):
     """
     Transforms the SQL result DataFrame into a list of invoice dictionaries.
@@ -16,139 +28,186 @@ def transform_to_invoices(df):
     Returns:
         list: List of invoice dictionaries or None if error occurs
     """
+    try:
+        invoices = list(iter_invoices(df))
+        logger.info("Transformation completed: %d invoices processed", len(invoices))
+        return invoices
+        
+    except Exception:
+        # iter_invoices already logged the error
+        return None
+
+def iter_invoices(df):
+    """
+    Lazily transforms the SQL result DataFrame into invoice dictionaries,
+    so each invoice can be uploaded as soon as it is built.
+    
+    Args:
+        df (pd.DataFrame): DataFrame from SQL query
+        
+    Yields:
+        dict: Invoice dictionary
+    """
     try:
         logger.info("Starting data transformation")
         
         if df is None or df.empty:
             logger.warning("No data to transform")
-            return []
+            return
         
-        invoices = []
+        df = df.dropna(subset=['id'])
+        if df.empty:
+            logger.warning("No invoices with an id to transform")
+            return
         
-        # Get unique invoice IDs
-        unique_invoices = df['id'].unique()
-        logger.info(f"Found {len(unique_invoices)} unique invoices to process")
+        # Row positions of every invoice; headers, totals and groups below
+        # all follow the same first-seen order, so they are zipped by position
+        groups = group_positions(df['id'])
+        logger.info("Found %d unique invoices to process", len(groups))
         
-        for invoice_id in unique_invoices:
-            if pd.isna(invoice_id):
-                continue
-                
-            # Filter data for this invoice
-            invoice_rows = df[df['id'] == invoice_id]
-            
-            if invoice_rows.empty:
-                continue
-                
-            # Get common invoice data from first row
-            first_row = invoice_rows.iloc[0]
-            
-            # Calculate totals
-            total_iva_excl = calculate_total_iva_excl(invoice_rows)
-            total_iva_incl = calculate_total_iva_incl(invoice_rows)
+        # Totals for every invoice in one vectorized reduction
+        totals = calculate_invoice_totals(df)
+        
+        # Convert output columns to native Python types once for the whole frame
+        rows = to_native_frame(df[HEADER_COLUMNS + PRODUCT_COLUMNS])
+        
+        # Common invoice data from the first row of every invoice, converted
+        # to dicts in one call
+        headers = rows.loc[~df['id'].duplicated(), HEADER_COLUMNS].to_dict(orient='records')
+        
+        # Product lines as a plain object array, sliced per invoice by position
+        products = rows[PRODUCT_COLUMNS].to_numpy()
+        
+        debug_enabled = logger.isEnabledFor(logging.DEBUG)
+        for first_row, positions, total_iva_excl, total_iva_incl in zip(
+            headers, groups,
+            totals['total_iva_excl'].tolist(), totals['total_iva_incl'].tolist()
+        ):
             total_iva = total_iva_incl - total_iva_excl
             
             # Create invoice structure
             invoice = {
-                "id": convert_to_native_type(first_row['id']),
-                "num_factura": convert_to_native_type(first_row['num_factura']),
-                "año_factura": convert_to_native_type(first_row['año_factura']),
-                "fecha_factura": convert_to_native_type(first_row['fecha_factura']),
+                "id": first_row['id'],
+                "num_factura": first_row['num_factura'],
+                "año_factura": first_row['año_factura'],
+                "fecha_factura": first_row['fecha_factura'],
                 "total_iva_excl": round(total_iva_excl, 2),
                 "total_iva": round(total_iva, 2),
                 "total_iva_incl": round(total_iva_incl, 2),
-                "observaciones": convert_to_native_type(first_row['observaciones']) or "",
-                "num_albaran": convert_to_native_type(first_row['num_albaran']),
-                "fecha_albaran": convert_to_native_type(first_row['fecha_albaran']),
-                "id_pedido": convert_to_native_type(first_row['id_pedido']),
-                "num_pedido": convert_to_native_type(first_row['num_pedido']),
-                "año_pedido": convert_to_native_type(first_row['año_pedido']),
-                "fecha_pedido": convert_to_native_type(first_row['fecha_pedido']),
-                "id_pedido_cliente": convert_to_native_type(first_row['id_pedido_cliente']),
-                "id_cliente": convert_to_native_type(first_row['id_cliente']),
-                "cliente": convert_to_native_type(first_row['cliente']),
-                "direccion": convert_to_native_type(first_row['direccion']),
-                "cod_postal": convert_to_native_type(first_row['cod_postal']),
-                "ciudad": convert_to_native_type(first_row['ciudad']),
-                "provincia": convert_to_native_type(first_row['provincia']),
-                "pais": convert_to_native_type(first_row['pais']),
-                "nif": convert_to_native_type(first_row['nif']),
-                "products": []
+                "observaciones": first_row['observaciones'] or "",
+                "num_albaran": first_row['num_albaran'],
+                "fecha_albaran": first_row['fecha_albaran'],
+                "id_pedido": first_row['id_pedido'],
+                "num_pedido": first_row['num_pedido'],
+                "año_pedido": first_row['año_pedido'],
+                "fecha_pedido": first_row['fecha_pedido'],
+                "id_pedido_cliente": first_row['id_pedido_cliente'],
+                "id_cliente": first_row['id_cliente'],
+                "cliente": first_row['cliente'],
+                "direccion": first_row['direccion'],
+                "cod_postal": first_row['cod_postal'],
+                "ciudad": first_row['ciudad'],
+                "provincia": first_row['provincia'],
+                "pais": first_row['pais'],
+                "nif": first_row['nif'],
+                "products": [
+                    {"product": dict(zip(PRODUCT_COLUMNS, line))}
+                    for line in products[positions].tolist()
+                ]
             }
             
-            # Add products
-            for _, row in invoice_rows.iterrows():
-                product = {
-                    "product": {
-                        "id_articulo": convert_to_native_type(row['id_articulo']),
-                        "descripcion": convert_to_native_type(row['descripcion']),
-                        "cantidad": convert_to_native_type(row['cantidad']),
-                        "precio": convert_to_native_type(row['precio']),
-                        "descuento": convert_to_native_type(row['descuento']),
-                        "total": convert_to_native_type(row['total'])
-                    }
-                }
-                invoice["products"].append(product)
-            
-            invoices.append(invoice)
-            logger.debug(f"Processed invoice {invoice_id} with {len(invoice_rows)} products")
-        
-        logger.info(f"Transformation completed: {len(invoices)} invoices processed")
-        return invoices
+            if debug_enabled:
+                logger.debug("Processed invoice %s with %d products", first_row['id'], len(positions))
+            yield invoice
         
     except Exception as e:
-        logger.error(f"Error during transformation: {str(e)}", exc_info=True)
-        return None
+        logger.error("Error during transformation: %s", e, exc_info=True)
+        raise
 
-def calculate_total_iva_excl(invoice_rows):
+def group_positions(ids):
     """
-    Calculates total excluding IVA.
+    Finds the row positions of every invoice without building a DataFrame
+    per group.
     
     Args:
-        invoice_rows (pd.DataFrame): Rows for a single invoice
+        ids (pd.Series): Invoice id of each row, without missing values
         
     Returns:
-        float: Total excluding IVA
+        list: One array of row positions per invoice, in first-seen order
     """
-    return invoice_rows['total'].sum()
+    values = ids.to_numpy()
+    if len(values) == 0:
+        return []
+    if (values == values[0]).all():
+        # Single invoice: every row is part of it
+        return [np.arange(len(values))]
+    
+    codes, _ = pd.factorize(values, sort=False)
+    order = np.argsort(codes, kind='stable')
+    return np.split(order, np.cumsum(np.bincount(codes))[:-1])
 
-def calculate_total_iva_incl(invoice_rows):
+def calculate_invoice_totals(df):
     """
-    Calculates total including IVA.
+    Calculates the totals excluding and including IVA of every invoice at once.
     
     Args:
-        invoice_rows (pd.DataFrame): Rows for a single invoice
+        df (pd.DataFrame): Rows of one or more invoices
         
     Returns:
-        float: Total including IVA
+        pd.DataFrame: Columns total_iva_excl and total_iva_incl indexed by invoice id
     """
-    total_with_iva = 0
-    for _, row in invoice_rows.iterrows():
-        line_total = row['total']
-        iva_rate = row['iva'] if not pd.isna(row['iva']) else 1.0
-        total_with_iva += line_total * iva_rate
+    return (
+        df.assign(_line_iva=line_totals_iva_incl(df))
+        .groupby('id', sort=False)
+        .agg(total_iva_excl=('total', 'sum'), total_iva_incl=('_line_iva', 'sum'))
+    )
+
+def line_totals_iva_incl(rows):
+    """
+    Calculates each line total including IVA (lines without IVA rate count at 1.0).
     
-    return total_with_iva
+    Args:
+        rows (pd.DataFrame): Invoice rows
+        
+    Returns:
+        pd.Series: Line totals including IVA
+    """
+    return rows['total'] * rows['iva'].fillna(1.0)
 
-def convert_to_native_type(value):
+def to_native_frame(df):
     """
-    Converts numpy/pandas values to native Python types for JSON serialization.
+    Converts a whole DataFrame to native Python values for JSON serialization.
+    Works for NumPy and Arrow-backed (pd.ArrowDtype) columns alike: both
+    yield Python scalars when cast to object, with missing values as None.
     
     Args:
-        value: Value to convert
+        df (pd.DataFrame): DataFrame to convert
         
     Returns:
-        Value converted to native Python type
+        pd.DataFrame: Object-dtype DataFrame with NaN/NaT replaced by None
     """
-    if pd.isna(value):
-        return None
-    elif isinstance(value, (np.integer, np.int64)):
-        return int(value)
-    elif isinstance(value, (np.floating, np.float64)):
-        return float(value)
-    elif isinstance(value, np.ndarray):
-        return value.tolist()
-    else:
-        return value
+    return df.astype(object).where(df.notna(), None)
+
+def generate_references(df):
+    """
+    Generates the filename reference of every invoice at once, with the
+    same rules as generate_reference.
+    
+    Args:
+        df (pd.DataFrame): DataFrame from SQL query
+        
+    Returns:
+        dict: Reference string by invoice id
+    """
+    # Work on native Python values, as generate_reference does, so every
+    # column backend formats the same way (e.g. str(3.0) == '3.0')
+    heads = to_native_frame(df.dropna(subset=['id']).drop_duplicates('id')[['id', 'id_pedido_cliente']])
+    id_pedido_cliente = heads['id_pedido_cliente']
+    has_order = id_pedido_cliente.astype(bool)
+    references = id_pedido_cliente.astype(str).where(
+        has_order, 'id_factura_' + heads['id'].astype(str)
+    )
+    return dict(zip(heads['id'].tolist(), references.tolist()))
 
 def generate_reference(invoice):
     """
@@ -1,9 +1,11 @@
 """
 Logging configuration for the SQL ETL process.
 """
+import atexit
 import os
 import logging
-from logging.handlers import RotatingFileHandler
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+import queue
 import sys
 from config.config import LOG_DIR, LOG_FILE, LOG_LEVEL
 
@@ -27,7 +29,8 @@ def setup_logging():
         LOG_FILE, 
         maxBytes=10485760,  # 10MB
         backupCount=5,
-        encoding='utf-8'
+        encoding='utf-8',
+        delay=True  # Open the log file on the first record, not at import
     )
     
     # Create formatters and add them to handlers
@@ -37,9 +40,15 @@ def setup_logging():
     console_handler.setFormatter(log_format)
     file_handler.setFormatter(log_format)
     
-    # Add handlers to the logger
-    logger.addHandler(console_handler)
-    logger.addHandler(file_handler)
+    # The logger only enqueues records; a background listener writes them,
+    # so console and file I/O (and log rollover) never block the caller
+    log_queue = queue.Queue(-1)
+    logger.addHandler(QueueHandler(log_queue))
+    listener = QueueListener(log_queue, console_handler, file_handler, respect_handler_level=True)
+    listener.start()
+    
+    # Flush pending records before the interpreter exits
+    atexit.register(listener.stop)
     
     return logger
 